@@ -10,9 +10,12 @@
 #
 # ------------------------------------------------------------------------------------------
 
-import sys, os, argparse
+import sys, os, argparse, functools, hashlib, json
 from osgeo import gdal, ogr, osr
 
+# proj4 strings of previously seen .prj files, keyed by sha1 of the ESRI WKT
+CACHE_FILE = os.path.expanduser('~/.cache/raspy/prj4.json')
+
 def get_ext(file):
 	name, ext = os.path.splitext(file)
 	return ext.replace('.', '')
@@ -22,12 +25,38 @@ def prj_ext(shp_file):
 	prj_file = '{}.prj'.format(name)
 	return prj_file
 
+def load_cache():
+	try:
+		with open(CACHE_FILE, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def save_cache(cache):
+	try:
+		os.makedirs(os.path.dirname(CACHE_FILE), exist_ok = True)
+		tmp_file = '{}.{}'.format(CACHE_FILE, os.getpid())
+		with open(tmp_file, 'w') as f:
+			json.dump(cache, f)
+		os.replace(tmp_file, CACHE_FILE)
+	except OSError:
+		pass
+
+@functools.lru_cache(maxsize = 256)
+def esri_to_proj4(prj_txt):
+	key = hashlib.sha1(prj_txt.encode()).hexdigest()
+	cache = load_cache()
+	if key not in cache:
+		srs = osr.SpatialReference()
+		srs.ImportFromESRI([prj_txt])
+		cache[key] = srs.ExportToProj4().rstrip()
+		save_cache(cache)
+	return cache[key]
+
 def get_shp_prj(prj_file):
 	prj_src = open(prj_file, 'r')
 	prj_txt = prj_src.read()
-	srs = osr.SpatialReference()
-	srs.ImportFromESRI([prj_txt])
-	prj4str = srs.ExportToProj4().rstrip()
+	prj4str = esri_to_proj4(prj_txt)
 	prj4str = "'{}'".format(prj4str)
 	print(prj4str, flush = True)
 
@@ -15,17 +15,16 @@ from raspy import *
 
 def human_readable_size(size, decimal_places = 2):
 	"""Returns a human-readable string representation of bytes. Credit: https://stackoverflow.com/a/43690506/9118975"""
-	for unit in ['B', 'KB', 'MB', 'GB', 'TB', 'PB']:
-		if size < 1024.0 or unit == 'PB':
-			break
-		size /= 1024.0
-	return f"{size:.{decimal_places}f} {unit}"
+	units = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
+	i = min(len(units) - 1, (int(size).bit_length() - 1) // 10) if size >= 1 else 0 # floor of log base 1024, exact for integers
+	return f"{size / (1 << (10 * i)):.{decimal_places}f} {units[i]}"
 
 def get_unc_size(f):
+	# both lookups share one cached gdal.Open of the file
 	num_cols, num_rows, num_bands = get_dims(f)
 	dtype = get_dtype(f)
 	bit_depth = dtype_bit_depth(dtype)
-	size_bytes = num_bands * num_rows * num_cols * (bit_depth / 8)
+	size_bytes = num_bands * num_rows * num_cols * bit_depth // 8
 	print(human_readable_size(size_bytes), flush = True)
 
 def main():
@@ -3,67 +3,120 @@
 # functions for working with raster data
 # written by seth gorelik, 2020
 
-from osgeo import gdal, osr
-from tabulate import tabulate
-from matplotlib import colors, colormaps
-import matplotlib.pyplot as plt
+from osgeo import gdal, gdal_array, osr
 import numpy as np
-import subprocess as sp
-import os, inspect
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import FunctionType, MappingProxyType
+import os, functools, tempfile
 
-def get_nodata(raster_file, band = 1):
-	"""Get raster nodata value"""
+def _configure_gdal():
+	"""Set GDAL runtime options suited to (cloud-optimized) GeoTIFF workflows, keeping any already set by the user"""
+	options = {
+		'GDAL_NUM_THREADS': 'ALL_CPUS',                               # use all cores for (de)compression
+		'GDAL_CACHEMAX': '512',                                       # block cache size (MB)
+		'GDAL_DISABLE_READDIR_ON_OPEN': 'TRUE',                       # skip directory listing on open
+		'VSI_CACHE': 'TRUE'                                           # cache remote (/vsi*) reads in memory
+	}
+	try:
+		import resource
+		soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+		options['GDAL_MAX_DATASET_POOL_SIZE'] = str(max(100, soft // 2)) # keep within the open file limit
+	except ImportError: # no resource module on Windows
+		pass
+	for key, val in options.items():
+		if gdal.GetConfigOption(key) is None:
+			gdal.SetConfigOption(key, val)
+
+_configure_gdal()
+
+_RasterMeta = namedtuple('_RasterMeta', ['gt', 'sr', 'nbands', 'ncols', 'nrows', 'dtypes', 'nodata'])
+
+@functools.lru_cache(maxsize = 128)
+def _open_meta(raster_file, mtime):
+	"""Read raster metadata with a single gdal.Open (cached by file path and modification time)"""
 	file = gdal.Open(raster_file)
-	nodata = file.GetRasterBand(band).GetNoDataValue()
+	bands = [file.GetRasterBand(i) for i in range(1, file.RasterCount + 1)]
+	meta = _RasterMeta(
+		gt = file.GetGeoTransform(),
+		sr = file.GetProjection(),
+		nbands = file.RasterCount,
+		ncols = file.RasterXSize,
+		nrows = file.RasterYSize,
+		dtypes = tuple(band.DataType for band in bands),
+		nodata = tuple(band.GetNoDataValue() for band in bands)
+	)
+	bands = None
 	file = None
-	return nodata
+	return meta
+
+def _mtime(raster_file):
+	"""Get file modification time, or None for paths not on the local file system (e.g., /vsicurl/)"""
+	return os.path.getmtime(raster_file) if os.path.exists(raster_file) else None
+
+def _get_meta(raster_file):
+	"""Get cached raster metadata, re-reading it if the file has changed on disk"""
+	return _open_meta(raster_file, _mtime(raster_file))
+
+def _band_exists(meta, raster_file, band):
+	"""Check a band number against a raster's cached metadata, printing an error if there is no such band"""
+	if isinstance(band, (int, np.integer)) and (1 <= band <= meta.nbands):
+		return True
+	print('Error: band {} does not exist, {} has {} band(s). There is no Band 0.'.format(band, raster_file, meta.nbands), flush = True)
+	return False
+
+def get_nodata(raster_file, band = 1):
+	"""Get raster nodata value"""
+	meta = _get_meta(raster_file)
+	if not _band_exists(meta, raster_file, band):
+		return
+	return meta.nodata[band - 1]
 
 def get_gt_sr(raster_file):
 	"""Get geotransform"""
-	file = gdal.Open(raster_file)
-	gt = file.GetGeoTransform()
-	sr = file.GetProjection()
-	file = None
-	return [gt, sr]
+	meta = _get_meta(raster_file)
+	return [meta.gt, meta.sr]
+
+@functools.lru_cache(maxsize = 256)
+def _srs_to_proj4(wkt):
+	"""Convert WKT to proj4 string (cached, so identical CRSs are only parsed once)"""
+	return osr.SpatialReference(wkt = wkt).ExportToProj4().rstrip()
+
+@functools.lru_cache(maxsize = 256)
+def _srs_units(wkt):
+	"""Get CRS units from WKT, as 'm' for meters, otherwise the lower case unit name (cached like _srs_to_proj4)"""
+	if not wkt:
+		return None
+	srs = osr.SpatialReference(wkt = wkt)
+	if srs.IsGeographic():
+		return srs.GetAngularUnitsName().lower()
+	units = srs.GetLinearUnitsName().lower()
+	return 'm' if units in ('metre', 'meter', 'metres', 'meters') else units
 
 def get_proj4str(raster_file):
 	"""Get proj4 string"""
-	file = gdal.Open(raster_file)
-	proj = osr.SpatialReference(wkt = file.GetProjection()).ExportToProj4().rstrip()
-	file = None
+	proj = _srs_to_proj4(_get_meta(raster_file).sr)
 	return proj
 
 def get_nbands(raster_file):
 	"""Get number of bands"""
-	file = gdal.Open(raster_file)
-	num_bands = file.RasterCount
-	file = None
-	return num_bands
+	return _get_meta(raster_file).nbands
 
 def get_dims(raster_file):
 	"""Get dimensions of raster file, without loading it into memory"""
-	file = gdal.Open(raster_file)
-	num_cols = file.RasterXSize
-	num_rows = file.RasterYSize
-	num_bands = file.RasterCount
-	file = None
-	return [num_cols, num_rows, num_bands]
+	meta = _get_meta(raster_file)
+	return [meta.ncols, meta.nrows, meta.nbands]
 
 def get_xy_res(raster_file):
 	"""Get X and Y resolution of raster file, without loading it into memory"""
-	file = gdal.Open(raster_file)
-	gt = file.GetGeoTransform()
-	file = None
+	gt = _get_meta(raster_file).gt
 	x_res = gt[1]
 	y_res = -gt[5]
 	return [x_res, y_res]
 
 def get_prj_units(raster_file):
 	"""Get units of raster file CRS, without loading it into memory"""
-	prj4_str = get_proj4str(raster_file)
-	prj4_str_list = prj4_str.split('+')
-	units_str = list(filter(lambda x: 'units' in x, prj4_str_list))[0]
-	units_str = units_str.strip().split('=')[1]
+	units_str = _srs_units(_get_meta(raster_file).sr)
 	return units_str
 
 def get_cell_area_ha(raster_file):
@@ -77,51 +130,50 @@ def get_cell_area_ha(raster_file):
 		print('Error: CRS units are {} (must be meters).'.format(units), flush = True)
 		return
 
+# lookup tables for raster data types, built once at import
+_DTYPE_GDAL = {
+	"Unknown" : gdal.GDT_Unknown,   # Unknown or unspecified type
+	"Byte" : gdal.GDT_Byte,         # Eight bit unsigned integer
+	"UInt16" : gdal.GDT_UInt16,     # Sixteen bit unsigned integer
+	"Int16" : gdal.GDT_Int16,       # Sixteen bit signed integer
+	"UInt32" : gdal.GDT_UInt32,     # Thirty two bit unsigned integer
+	"Int32" : gdal.GDT_Int32,       # Thirty two bit signed integer
+	"Float32" : gdal.GDT_Float32,   # Thirty two bit floating point
+	"Float64" : gdal.GDT_Float64,   # Sixty four bit floating point
+	"CInt16" : gdal.GDT_CInt16,     # Complex Int16
+	"CInt32" : gdal.GDT_CInt32,     # Complex Int32
+	"CFloat32" : gdal.GDT_CFloat32, # Complex Float32
+	"CFloat64" : gdal.GDT_CFloat64  # Complex Float64
+}
+
+_DTYPE_NAME = MappingProxyType({dtype_int : gdal.GetDataTypeName(dtype_int) for dtype_int in range(gdal.GDT_TypeCount)})
+
+# also accept any types added in newer GDAL versions (e.g., Int8, Int64, UInt64)
+_DTYPE_GDAL = MappingProxyType({**{dtype_str : dtype_int for dtype_int, dtype_str in _DTYPE_NAME.items()}, **_DTYPE_GDAL})
+
 def get_dtype(raster_file, band = 1):
 	"""Get raster data type"""
-	file = gdal.Open(raster_file)
-	dtype_int = file.GetRasterBand(band).DataType
-	dtype_str = gdal.GetDataTypeName(dtype_int)
-	file = None
+	meta = _get_meta(raster_file)
+	if not _band_exists(meta, raster_file, band):
+		return
+	dtype_int = meta.dtypes[band - 1]
+	dtype_str = _DTYPE_NAME[dtype_int]
 	return dtype_str
 
 def dtype_gdal(dtype_str):
 	"""Translate data type from string to GDAL data type (integer)"""
-	dtype_switcher = {
-		"Unknown" : gdal.GDT_Unknown,   # Unknown or unspecified type
-		"Byte" : gdal.GDT_Byte,         # Eight bit unsigned integer
-		"UInt16" : gdal.GDT_UInt16,     # Sixteen bit unsigned integer
-		"Int16" : gdal.GDT_Int16,       # Sixteen bit signed integer
-		"UInt32" : gdal.GDT_UInt32,     # Thirty two bit unsigned integer
-		"Int32" : gdal.GDT_Int32,       # Thirty two bit signed integer
-		"Float32" : gdal.GDT_Float32,   # Thirty two bit floating point
-		"Float64" : gdal.GDT_Float64,   # Sixty four bit floating point
-		"CInt16" : gdal.GDT_CInt16,     # Complex Int16
-		"CInt32" : gdal.GDT_CInt32,     # Complex Int32
-		"CFloat32" : gdal.GDT_CFloat32, # Complex Float32
-		"CFloat64" : gdal.GDT_CFloat64  # Complex Float64
-	}
-	dtype_int = dtype_switcher.get(dtype_str, 0)
+	dtype_int = _DTYPE_GDAL.get(dtype_str, 0)
 	return dtype_int
 
 def dtype_bit_depth(dtype_str):
 	"""Get pixel bit depth from raster data type"""
-	bit_depth_switcher = {
-		"Byte" : 8,
-		"UInt16" : 16,
-		"Int16" : 16,
-		"UInt32" : 32,
-		"Int32" : 32,
-		"Float32" : 32,
-		"Float64" : 64,
-		"CInt16" : 16,
-		"CInt32" : 32,
-		"CFloat32" : 32,
-		"CFloat64" : 64
-	}
-	bit_depth = bit_depth_switcher.get(dtype_str, 0)
+	bit_depth = gdal.GetDataTypeSize(dtype_gdal(dtype_str))
 	return bit_depth
 
+# arrays read by raster(cache = True), least recently used first
+_RASTER_CACHE = OrderedDict()
+_RASTER_CACHE_MAX_BYTES = 1024 ** 3
+
 def r2n(raster_file, band = 1):
 	"""Load a raster from disk into a 2D numpy array in memory."""
 	print('WARNING: r2n() is depreciated, use raster() instead!', flush = True)
@@ -130,38 +182,204 @@ def r2n(raster_file, band = 1):
 	file = None
 	return img
 
-def raster(raster_file, bands = None, verbose = False):
-	"""Load single- or multi-band raster from disk into a 2- or 3-dimensional numpy array in memory.\nNote, bands must be INTEGER or LIST of integers, e.g., [1, 3, 6] = Bands 1, 3 and 6. There is no Band 0."""
-	if verbose: print('Reading {} ...'.format(raster_file), flush = True)
+def _empty(shape, dtype, memmap = False):
+	"""Allocate an output array in memory, or as a numpy memmap backed by a temporary file on disk"""
+	if memmap:
+		return np.memmap(tempfile.TemporaryFile(prefix = 'raspy_'), dtype = dtype, mode = 'w+', shape = shape)
+	return np.empty(shape, dtype = dtype)
+
+def _block_windows(band, window = None):
+	"""Yield (xoff, yoff, xsize, ysize) windows aligned with the natural blocks (tiles or strips) of a raster band, clipped to window (xoff, yoff, xsize, ysize)"""
+	bx, by = band.GetBlockSize()
+	xoff, yoff, xsize, ysize = window or (0, 0, band.XSize, band.YSize)
+	for y in range(yoff - yoff % by, yoff + ysize, by):
+		y0, y1 = max(y, yoff), min(y + by, yoff + ysize)
+		for x in range(xoff - xoff % bx, xoff + xsize, bx):
+			x0, x1 = max(x, xoff), min(x + bx, xoff + xsize)
+			yield x0, y0, x1 - x0, y1 - y0
+
+def _read_band(band, out, block = False, window = None):
+	"""Read a window (default: all) of a raster band into a pre-allocated 2D numpy array, optionally one natural block at a time.\nGDAL resamples the window to the shape of out (using overviews where available) if they differ.\nReturns None if GDAL fails to read (out is then incomplete)."""
+	xoff, yoff, xsize, ysize = window or (0, 0, band.XSize, band.YSize)
+	if block and (out.shape == (ysize, xsize)):
+		for x, y, xs, ys in _block_windows(band, window):
+			if band.ReadAsArray(x, y, xs, ys, buf_obj = out[y - yoff:y - yoff + ys, x - xoff:x - xoff + xs]) is None:
+				return
+	elif band.ReadAsArray(xoff, yoff, xsize, ysize, buf_xsize = out.shape[1], buf_ysize = out.shape[0], buf_obj = out) is None:
+		return
+	return out
+
+def _read_band_file(raster_file, band, out, block = False, window = None):
+	"""Open a raster and read one band into a pre-allocated 2D numpy array (for use in worker threads)"""
 	file = gdal.Open(raster_file)
+	out = _read_band(file.GetRasterBand(band), out, block, window)
+	file = None
+	return out
+
+def _read_all(file, raster_file, bands, verbose = False, block = False, threaded = False, memmap = False, window = None, out_shape = None):
+	"""Read all bands of an open raster (bands = None)"""
 	tot_band_cnt = file.RasterCount
-	if bands == None:
-		if (verbose) & (tot_band_cnt == 1): print('Raster has 1 band ...', flush = True)
-		if (verbose) & (tot_band_cnt > 1): print('Reading all {} bands ...'.format(tot_band_cnt), flush = True)
-		arr = file.ReadAsArray()
-	elif type(bands) == int: # in this case, "bands" refers to only one band
-		if verbose: print('Reading band {} of {} ...'.format(bands, tot_band_cnt), flush = True)
-		arr = file.GetRasterBand(bands).ReadAsArray()
-	elif type(bands) == list:
-		arr_list = []
-		for band in bands:
+	if (verbose) & (tot_band_cnt == 1): print('Raster has 1 band ...', flush = True)
+	if (verbose) & (tot_band_cnt > 1): print('Reading all {} bands ...'.format(tot_band_cnt), flush = True)
+	if not block:
+		return file.ReadAsArray(*window, buf_xsize = out_shape[1], buf_ysize = out_shape[0])
+	band = file.GetRasterBand(1)
+	dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+	if tot_band_cnt == 1:
+		arr = _empty(out_shape, dtype, memmap)
+		return _read_band(band, arr, block, window)
+	arr = _empty((tot_band_cnt,) + out_shape, dtype, memmap)
+	if out_shape != (window[3], window[2]):
+		return file.ReadAsArray(*window, buf_xsize = out_shape[1], buf_ysize = out_shape[0], buf_obj = arr)
+	# read all bands of each block together, so pixel-interleaved tiles are only decoded once
+	xoff, yoff = window[:2]
+	for x, y, xs, ys in _block_windows(band, window):
+		if file.ReadAsArray(x, y, xs, ys, buf_obj = arr[:, y - yoff:y - yoff + ys, x - xoff:x - xoff + xs]) is None:
+			return
+	return arr
+
+def _read_one(file, raster_file, bands, verbose = False, block = False, threaded = False, memmap = False, window = None, out_shape = None):
+	"""Read a single band of an open raster (bands = INTEGER)"""
+	if verbose: print('Reading band {} of {} ...'.format(bands, file.RasterCount), flush = True)
+	band = file.GetRasterBand(bands)
+	if not block:
+		return band.ReadAsArray(*window, buf_xsize = out_shape[1], buf_ysize = out_shape[0])
+	arr = _empty(out_shape, gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType), memmap)
+	return _read_band(band, arr, block, window)
+
+def _read_list(file, raster_file, bands, verbose = False, block = False, threaded = False, memmap = False, window = None, out_shape = None):
+	"""Read a list of bands of an open raster (bands = LIST), each straight into its slice of the output rather than stacking copies"""
+	dtype = gdal_array.GDALTypeCodeToNumericTypeCode(file.GetRasterBand(bands[0]).DataType)
+	arr = _empty((len(bands),) + out_shape, dtype, memmap)
+	if threaded:
+		# each worker opens its own handle, since a GDAL dataset must not be shared across threads
+		with ThreadPoolExecutor(max_workers = min(len(bands), os.cpu_count() or 1)) as executor:
+			jobs = []
+			for i, band in enumerate(bands):
+				if verbose: print('Reading band {} ...'.format(band), flush = True)
+				jobs.append(executor.submit(_read_band_file, raster_file, band, arr[i], block, window))
+			if any(job.result() is None for job in jobs):
+				return
+	elif block:
+		for i, band in enumerate(bands):
 			if verbose: print('Reading band {} ...'.format(band), flush = True)
-			tmp_arr = file.GetRasterBand(band).ReadAsArray()
-			arr_list.append(tmp_arr)
-		arr = np.stack(arr_list, axis = 0)
+			if _read_band(file.GetRasterBand(band), arr[i], block, window) is None:
+				return
 	else:
+		if verbose: print('Reading bands {} ...'.format(bands), flush = True)
+		try:
+			# read all bands in one call, so GDAL can reuse each decoded block across bands
+			return file.ReadAsArray(*window, buf_xsize = out_shape[1], buf_ysize = out_shape[0], buf_obj = arr, band_list = bands)
+		except TypeError: # band_list not supported by older GDAL
+			for i, band in enumerate(bands):
+				if _read_band(file.GetRasterBand(band), arr[i], window = window) is None:
+					return
+	return arr
+
+# raster() read path for each type of bands argument
+_READERS = {type(None): _read_all, int: _read_one, list: _read_list}
+
+def _read_raster(raster_file, bands = None, verbose = False, block = False, threaded = False, memmap = False, window = None, out_shape = None):
+	"""Read raster bands from disk into a 2- or 3-dimensional numpy array (see raster())"""
+	if memmap: block = True # stream into the memory map rather than reading whole bands at once
+	reader = _READERS.get(type(bands))
+	if reader is None:
 		print('Error: bands argument must be type INTEGER or LIST (of integers), e.g., [1, 3, 6] = Bands 1, 3 and 6. There is no Band 0.', flush = True)
 		return
+	if (window is not None) and (len(window) != 4):
+		print('Error: window must be (xoff, yoff, xsize, ysize) in pixels.', flush = True)
+		return
+	if (out_shape is not None) and (len(out_shape) != 2):
+		print('Error: out_shape must be (rows, cols).', flush = True)
+		return
+	if isinstance(bands, list) and (len(bands) == 0):
+		print('Error: bands list is empty.', flush = True)
+		return
+	if verbose: print('Reading {} ...'.format(raster_file), flush = True)
+	file = gdal.Open(raster_file)
+	if file is None:
+		print('Error: could not open {}.'.format(raster_file), flush = True)
+		return
+	for band in (bands if isinstance(bands, list) else [] if bands is None else [bands]):
+		if not (isinstance(band, int) and (1 <= band <= file.RasterCount)):
+			print('Error: band {} does not exist, {} has {} band(s). There is no Band 0.'.format(band, raster_file, file.RasterCount), flush = True)
+			file = None
+			return
+	window = tuple(int(i) for i in window) if window is not None else (0, 0, file.RasterXSize, file.RasterYSize)
+	xoff, yoff, xsize, ysize = window
+	if not ((xoff >= 0) and (yoff >= 0) and (xsize > 0) and (ysize > 0) and (xoff + xsize <= file.RasterXSize) and (yoff + ysize <= file.RasterYSize)):
+		print('Error: window {} is outside of {} ({} cols, {} rows).'.format(window, raster_file, file.RasterXSize, file.RasterYSize), flush = True)
+		file = None
+		return
+	out_shape = tuple(int(i) for i in out_shape) if out_shape is not None else (ysize, xsize)
+	if min(out_shape) <= 0:
+		print('Error: out_shape must be positive (rows, cols).', flush = True)
+		file = None
+		return
+	arr = reader(file, raster_file, bands, verbose, block, threaded, memmap, window, out_shape)
 	file = None
+	if arr is None:
+		print('Error: could not read {}.'.format(raster_file), flush = True)
+	return arr
+
+def _cache_raster(key, arr):
+	"""Add an array to the raster cache, evicting the least recently used arrays beyond the size limit"""
+	if arr.nbytes > _RASTER_CACHE_MAX_BYTES:
+		return
+	arr.setflags(write = False) # a cached array is shared between callers
+	_RASTER_CACHE[key] = arr
+	while sum(cached.nbytes for cached in _RASTER_CACHE.values()) > _RASTER_CACHE_MAX_BYTES:
+		_RASTER_CACHE.popitem(last = False)
+
+def _by_band(arr, bands):
+	"""Split a raster array into a dictionary of 2D arrays keyed by band number (views of arr, not copies)"""
+	if arr.ndim == 2:
+		return {bands if isinstance(bands, int) else 1: arr}
+	band_nums = bands if isinstance(bands, list) else range(1, arr.shape[0] + 1)
+	return {band: arr[i] for i, band in enumerate(band_nums)}
+
+def raster(raster_file, bands = None, verbose = False, block = False, threaded = False, cache = False, memmap = False, layout = 'stack', window = None, out_shape = None):
+	"""Load single- or multi-band raster from disk into a 2- or 3-dimensional numpy array in memory.\nNote, bands must be INTEGER or LIST of integers, e.g., [1, 3, 6] = Bands 1, 3 and 6. There is no Band 0.\nSet block = True to read each band block-by-block (following the file's internal tiling) into the output array.\nSet threaded = True to read a LIST of bands concurrently, one thread per band.\nSet memmap = True to return a numpy memmap backed by a temporary file on disk, for rasters too large to hold in memory.\nSet cache = True to keep the (read-only) array in memory and return it on later calls until the file changes; see clear_cache().\nSet layout = 'soa' to get a dictionary of contiguous 2D arrays keyed by band number instead of a single array.\nSet window = (xoff, yoff, xsize, ysize) to read only that pixel window of the raster.\nSet out_shape = (rows, cols) to resample the window (default: all) to that size; when smaller, GDAL reads from overviews if the file has them."""
+	if layout not in ('stack', 'soa'):
+		print("Error: layout must be 'stack' or 'soa'.", flush = True)
+		return
+	# GDAL only accepts python integers as band numbers (e.g., not np.int64 from np.arange)
+	if isinstance(bands, np.integer):
+		bands = int(bands)
+	elif isinstance(bands, list):
+		bands = [int(band) if isinstance(band, np.integer) else band for band in bands]
+	cache = cache and not memmap # memmaps already live on disk
+	arr = None
+	if cache:
+		key = (os.path.abspath(raster_file) if os.path.exists(raster_file) else raster_file, _mtime(raster_file), tuple(bands) if isinstance(bands, list) else bands, tuple(window) if window is not None else None, tuple(out_shape) if out_shape is not None else None)
+		arr = _RASTER_CACHE.get(key)
+		if arr is not None:
+			if verbose: print('Using cached {} ...'.format(raster_file), flush = True)
+			_RASTER_CACHE.move_to_end(key)
+	if arr is None:
+		arr = _read_raster(raster_file, bands, verbose, block, threaded, memmap, window, out_shape)
+		if cache and (arr is not None):
+			_cache_raster(key, arr)
+	if (arr is not None) and (layout == 'soa'):
+		arr = _by_band(arr, bands)
 	return arr
+
+def clear_cache():
+	"""Clear cached raster arrays, metadata and compiled raster_apply() kernels"""
+	_RASTER_CACHE.clear()
+	_open_meta.cache_clear()
+	_srs_to_proj4.cache_clear()
+	_srs_units.cache_clear()
+	_APPLY_KERNELS.clear()
 	
 def write_gtiff(img_arr, out_tif, dtype, gt, sr, nodata = None, stats = True, msg = False):
-	"""Write a 2D numpy image array to a GeoTIFF raster file on disk"""
+	"""Write a 2D (rows, cols) or 3D (bands, rows, cols) numpy image array to a GeoTIFF raster file on disk"""
 	
 	# check that output is a numpy array
-	if type(img_arr) != np.ndarray:
+	if not isinstance(img_arr, np.ndarray):
 		print('Error: numpy array invalid', flush = True)
 		return
+	img_arr = np.ascontiguousarray(img_arr) # avoid a strided copy inside GDAL
 	
 	# check gdal data type
 	dtype_int = dtype_gdal(dtype)
@@ -171,28 +389,163 @@ def write_gtiff(img_arr, out_tif, dtype, gt, sr, nodata = None, stats = True, ms
 	
 	if msg: print('Writing {} ...'.format(out_tif), flush = True)
 	ndim = img_arr.ndim
-	nband = 1
-	nrow = img_arr.shape[0]
-	ncol = img_arr.shape[1]
+	if ndim == 3:
+		nband, nrow, ncol = img_arr.shape
+	else:
+		nband = 1
+		nrow, ncol = img_arr.shape
+	
+	# tiled output for fast partial reads, with a predictor to shrink LZW output
+	block_size = 512
+	options = ['COMPRESS=LZW', 'TILED=YES', 'BLOCKXSIZE={}'.format(block_size), 'BLOCKYSIZE={}'.format(block_size), 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+	if dtype in ('Byte', 'UInt16', 'Int16', 'UInt32', 'Int32'):
+		options.append('PREDICTOR=2') # horizontal differencing
+	elif dtype in ('Float32', 'Float64'):
+		options.append('PREDICTOR=3') # floating point
+	
 	driver = gdal.GetDriverByName('GTiff')
-	out_dataset = driver.Create(out_tif, ncol, nrow, nband, dtype_int, options = [ 'COMPRESS=LZW' ])
+	out_dataset = driver.Create(out_tif, ncol, nrow, nband, dtype_int, options = options)
 	out_dataset.SetGeoTransform(gt)
 	out_dataset.SetProjection(sr)
-	out_dataset.GetRasterBand(1).WriteArray(img_arr)
-	if (nodata != None) and (type(nodata) != str):
-		out_dataset.GetRasterBand(1).SetNoDataValue(nodata)
+	# write one row of tiles at a time, so GDAL can compress and flush each as it is completed
+	for y in range(0, nrow, block_size):
+		if ndim == 3:
+			rows = img_arr[:, y:y + block_size]
+			if hasattr(out_dataset, 'WriteArray'): # all bands in one call (GDAL >= 3.1)
+				out_dataset.WriteArray(rows, 0, y)
+			else:
+				for i in range(nband):
+					out_dataset.GetRasterBand(i + 1).WriteArray(rows[i], 0, y)
+		else:
+			out_dataset.GetRasterBand(1).WriteArray(img_arr[y:y + block_size], 0, y)
+	out_dataset.FlushCache()
+	for i in range(nband):
+		out_band = out_dataset.GetRasterBand(i + 1)
+		if (nodata is not None) and not isinstance(nodata, str):
+			out_band.SetNoDataValue(nodata)
+		if stats: out_band.ComputeStatistics(False)
+	out_band = None
 	out_dataset = None
-	if stats: cmd_chk = sp.run(['gdal_edit.py', '-stats', out_tif])
 	return
 
+# number of cells processed at a time by chunked array operations
+_CHUNK_SIZE = 1 << 20
+
+def _valid_chunks(img_arr, nodata = None):
+	"""Yield the non-empty flat chunks of a numpy array, with nodata cells removed"""
+	flat = img_arr.reshape(-1)
+	for i in range(0, flat.size, _CHUNK_SIZE):
+		chunk = flat[i:i + _CHUNK_SIZE]
+		if nodata is not None:
+			chunk = chunk[chunk != nodata]
+		if chunk.size > 0:
+			yield chunk
+
+def _merge_min_max(img_min, img_max, chunk):
+	"""Merge the min and max of a chunk into running values (None before the first chunk), propagating NaN as np.min and np.max do"""
+	chunk_min = chunk.min()
+	chunk_max = chunk.max()
+	if img_min is None:
+		return chunk_min, chunk_max
+	return np.minimum(img_min, chunk_min), np.maximum(img_max, chunk_max)
+
+def _min_max(img_arr, nodata = None):
+	"""Get min and max of a numpy array, skipping nodata, in a single pass over memory (a chunk at a time)"""
+	img_min = img_max = None
+	for chunk in _valid_chunks(img_arr, nodata):
+		img_min, img_max = _merge_min_max(img_min, img_max, chunk)
+	return img_min, img_max
+
+def _summary_stats(img_arr, nodata = None):
+	"""
+	Get min, max, mean and std of a numpy array, skipping nodata, in a single pass over memory.
+	The array is processed in cache-sized chunks, whose means and sums of squared deviations are merged
+	with Chan et al.'s parallel variance update (stable, unlike accumulating a raw sum of squares).
+	"""
+	cnt = 0
+	mean = 0.0
+	m2 = 0.0
+	img_min = img_max = None
+	for chunk in _valid_chunks(img_arr, nodata):
+		img_min, img_max = _merge_min_max(img_min, img_max, chunk)
+		chunk = chunk.astype(np.float64)
+		chunk_mean = chunk.mean()
+		chunk -= chunk_mean
+		chunk_m2 = np.dot(chunk, chunk)
+		delta = chunk_mean - mean
+		tot = cnt + chunk.size
+		mean += delta * chunk.size / tot
+		m2 += chunk_m2 + delta * delta * cnt * chunk.size / tot
+		cnt = tot
+	if cnt == 0:
+		return None, None, None, None
+	return img_min, img_max, mean, np.sqrt(m2 / cnt)
+
+def _add_counts(cnts, more):
+	"""Add two np.bincount results of possibly different lengths, in place into the longer one"""
+	if more.size > cnts.size:
+		more[:cnts.size] += cnts
+		return more
+	cnts[:more.size] += more
+	return cnts
+
+def _bincount_range(flat, start, stop):
+	"""Count values of flat[start:stop] with np.bincount, a chunk at a time, into a single count array"""
+	cnts = np.zeros(0, dtype = np.intp)
+	for i in range(start, stop, _CHUNK_SIZE):
+		cnts = _add_counts(cnts, np.bincount(flat[i:min(i + _CHUNK_SIZE, stop)]))
+	return cnts
+
+def _bincount(img_arr):
+	"""
+	Count values of a small non-negative integer array with np.bincount, a chunk at a time across threads.
+	np.bincount copies its input to int64 and releases the GIL while counting, so chunks bound that copy and can run in parallel.
+	Each thread counts one contiguous range of chunks into its own array, so memory is bounded by the number of threads, not chunks.
+	"""
+	flat = img_arr.reshape(-1)
+	if flat.size <= _CHUNK_SIZE:
+		return np.bincount(flat)
+	num_chunks = -(-flat.size // _CHUNK_SIZE)
+	num_workers = min(num_chunks, os.cpu_count() or 1)
+	step = -(-num_chunks // num_workers) * _CHUNK_SIZE
+	cnts = np.zeros(0, dtype = np.intp)
+	with ThreadPoolExecutor(max_workers = num_workers) as executor:
+		for range_cnts in executor.map(lambda i: _bincount_range(flat, i, min(i + step, flat.size)), range(0, flat.size, step)):
+			cnts = _add_counts(cnts, range_cnts)
+	return cnts
+
+def _bincountable(img_arr):
+	"""Check if an array holds small non-negative integers, so its classes can be counted with np.bincount"""
+	if not np.issubdtype(img_arr.dtype, np.integer) or (img_arr.size == 0):
+		return False
+	if (img_arr.dtype.kind == 'u') and (img_arr.dtype.itemsize <= 2):
+		return True
+	return (img_arr.min() >= 0) and (img_arr.max() < (1 << 20))
+
 def stats(img_arr, nodata = None, classes = False):
-	"""Get descriptive statistics for either a numpy array"""
+	"""Get descriptive statistics for either a numpy array or a raster file on disk (band 1)"""
+	from tabulate import tabulate # imported here, as it is only needed for printing stats
+	if isinstance(img_arr, str):
+		# read band 1 as is (no extra copy), defaulting to the file's nodata value
+		if nodata is None: nodata = get_nodata(img_arr)
+		img_arr = raster(img_arr, bands = 1)
 	if isinstance(img_arr, np.ndarray):
-		if nodata is not None:
-			img_arr = img_arr[img_arr != nodata]
 		if classes:
-			vals, cnts = np.unique(img_arr, return_counts = True)
-			props = (cnts / img_arr.size) * 100
+			if _bincountable(img_arr):
+				# count classes in one linear pass, rather than sorting the whole array
+				cnts = _bincount(img_arr)
+				if (nodata is not None) and np.isfinite(nodata) and (nodata == int(nodata)) and (0 <= nodata < cnts.size):
+					cnts[int(nodata)] = 0
+				vals = np.flatnonzero(cnts)
+				cnts = cnts[vals]
+			else:
+				vals, cnts = np.unique(img_arr, return_counts = True)
+				if nodata is not None:
+					# drop the nodata class from the counts, rather than filtering a copy of the array
+					keep = vals != nodata
+					vals = vals[keep]
+					cnts = cnts[keep]
+			props = cnts * (100.0 / max(cnts.sum(), 1)) # one scaling pass, rather than a divide then a multiply
 			table_data = [
 				[cls, cnt, prp] for cls, cnt, prp in zip(vals, cnts, props)
 			]
@@ -200,57 +553,173 @@ def stats(img_arr, nodata = None, classes = False):
 			headers = ["Class", "Count", "%"]
 			print(tabulate(table_data, headers = headers, tablefmt = "plain", floatfmt = ["", ".0f", ".1f"],), flush = True)
 		else:
-			img_min = np.min(img_arr)
-			img_max = np.max(img_arr)
-			img_mean = np.mean(img_arr)
-			img_std = np.std(img_arr)
+			img_min, img_max, img_mean, img_std = _summary_stats(img_arr, nodata)
 			stats_dict = {"Min.": img_min, "Max.": img_max, "Mean": img_mean, "Std.": img_std, "NoData": nodata}
 			print(tabulate([stats_dict], headers = "keys", tablefmt = "plain", floatfmt = "2.2f", missingval = "-"), flush = True)
 	else:
-		print("Error: input must be a numpy array.", flush = True)
+		print("Error: input must be a numpy array or raster file.", flush = True)
 		return
 
 def compare_rasters(r1, r2):
 	"""Compare cells of two rasters (numpy arrays)"""
-	if (type(r1) != np.ndarray) or (type(r2) != np.ndarray):
+	if not (isinstance(r1, np.ndarray) and isinstance(r2, np.ndarray)):
 		print('Error: inputs must be numpy arrays.', flush = True)
 		return
 	elif (r1.shape != r2.shape):
 		print('Error: inputs must have the same dimensions.', flush = True)
 		return
+	elif (r1.size == 0):
+		print('Error: inputs are empty.', flush = True)
+		return
 	else:
-		ind_same = r1 == r2
-		num_same = np.sum(ind_same)
 		num_pxl = r1.size
+		if r1.flags.c_contiguous and r2.flags.c_contiguous:
+			# compare in chunks into one reusable buffer, rather than allocating a full-size boolean array
+			r1_flat = r1.reshape(-1)
+			r2_flat = r2.reshape(-1)
+			buf = np.empty(min(num_pxl, _CHUNK_SIZE), dtype = bool)
+			num_same = 0
+			for i in range(0, num_pxl, _CHUNK_SIZE):
+				j = min(i + _CHUNK_SIZE, num_pxl)
+				num_same += np.count_nonzero(np.equal(r1_flat[i:j], r2_flat[i:j], out = buf[:j - i]))
+		else:
+			num_same = np.count_nonzero(r1 == r2)
 		per_same = round(num_same/num_pxl*100, 2)
 		print('{}% of pixels are identical ({}/{} pixels)'.format(per_same, num_same, num_pxl), flush = True)
 		return
 
+# compiled raster_apply() kernels, least recently used first
+_APPLY_KERNELS = OrderedDict()
+_APPLY_KERNELS_MAX = 64
+
+@functools.lru_cache(maxsize = None)
+def _import_numba():
+	"""Import numba once, or get None if it is not installed (it is optional)"""
+	try:
+		import numba
+	except ImportError:
+		return None
+	return numba
+
+def _apply_key(func, src_dtype):
+	"""
+	Kernel cache key: the function's code, defaults, closure values and the values of the globals it reads,
+	since numba compiles all of these in as constants (so identical inline lambdas share a kernel, and a rebound global recompiles).
+	Returns None, so the kernel is not cached, if any of them is unhashable (e.g., an array).
+	"""
+	code = func.__code__
+	try:
+		closure = tuple((type(val), val) for val in (cell.cell_contents for cell in func.__closure__ or ()))
+		global_vals = tuple((name, type(func.__globals__[name]), func.__globals__[name]) for name in code.co_names if name in func.__globals__)
+		key = (code, func.__defaults__, closure, global_vals, src_dtype)
+		hash(key)
+	except (TypeError, ValueError): # ValueError: an unassigned variable in the closure
+		return None
+	return key
+
+def _apply_kernel(func, src_dtype):
+	"""
+	Get a parallel numba kernel applying func to every cell of a flat array, and the dtype func returns for src_dtype
+	(numba unifies the types of all branches, e.g., int and float to float64). Compiled once per function and input dtype.
+	Returns (None, None) if numba is not installed, func is not a python function, or numba cannot compile it.
+	"""
+	numba = _import_numba()
+	if (numba is None) or not isinstance(func, FunctionType):
+		return None, None
+	key = _apply_key(func, src_dtype)
+	if (key is not None) and (key in _APPLY_KERNELS):
+		_APPLY_KERNELS.move_to_end(key)
+		return _APPLY_KERNELS[key]
+	pixel_func = numba.njit(func)
+	@numba.njit(parallel = True)
+	def kernel(src, dst):
+		for i in numba.prange(src.size):
+			dst[i] = pixel_func(src[i])
+	try:
+		pixel_func.compile((numba.from_dtype(src_dtype),))
+		func_dtype = numba.np.numpy_support.as_dtype(pixel_func.nopython_signatures[0].return_type)
+	except numba.core.errors.NumbaError: # func uses python features numba does not support, or returns a non-numeric type
+		kernel = func_dtype = None
+	if key is not None:
+		_APPLY_KERNELS[key] = (kernel, func_dtype)
+		if len(_APPLY_KERNELS) > _APPLY_KERNELS_MAX:
+			_APPLY_KERNELS.popitem(last = False)
+	return kernel, func_dtype
+
+def raster_apply(img_arr, func, dtype = None):
+	"""Apply a per-pixel function (e.g., lambda x: x * 0.5 + 1) to every cell of a numpy array, returning a new array of the same shape.\nfunc is always called with a single pixel value, so it may use if statements (e.g., lambda x: x if x > 2 else 0).\nIf numba is installed, func is JIT-compiled into a parallel kernel (cached, see clear_cache()); otherwise it is called once per pixel, which is slow.\nUnless dtype is given, the output dtype is the input dtype promoted with the type func returns (with numba, over all branches of func; without, for the first cell)."""
+	if not isinstance(img_arr, np.ndarray):
+		print('Error: input must be a numpy array.', flush = True)
+		return
+	if not callable(func):
+		print('Error: func must be a function of one pixel value.', flush = True)
+		return
+	src = np.ascontiguousarray(img_arr).reshape(-1)
+	if isinstance(func, np.ufunc):
+		kernel, func_dtype = None, func(src[:0]).dtype # a numpy ufunc gives its output dtype for an empty array
+	else:
+		kernel, func_dtype = _apply_kernel(func, src.dtype)
+	if dtype is None:
+		if (func_dtype is None) and (src.size > 0):
+			func_dtype = np.result_type(func(src[0]))
+		dtype = img_arr.dtype if func_dtype is None else np.result_type(img_arr.dtype, func_dtype) # never narrower than the input
+	out = np.empty(img_arr.shape, dtype = dtype)
+	dst = out.reshape(-1)
+	if isinstance(func, np.ufunc):
+		# a numpy ufunc gives the same result on whole chunks as pixel by pixel
+		for i in range(0, src.size, _CHUNK_SIZE):
+			dst[i:i + _CHUNK_SIZE] = func(src[i:i + _CHUNK_SIZE])
+		return out
+	if kernel is not None:
+		try:
+			kernel(src, dst)
+			return out
+		except _import_numba().core.errors.NumbaError: # e.g., func returns a type that cannot be cast to dtype
+			pass
+	pixel_func = np.vectorize(func, otypes = [dst.dtype])
+	for i in range(0, src.size, _CHUNK_SIZE):
+		dst[i:i + _CHUNK_SIZE] = pixel_func(src[i:i + _CHUNK_SIZE])
+	return out
+
+# arrays larger than this (rows or columns) are decimated before plotting, unless axes are shown
+_PLOT_MAX_SIZE = 2048
+
 def plot(img_arr, pal = 'viridis', nodata = None, nodata_color = 'black', zmin = None, zmax = None, title = None, legend = True, units = None, close = True, axes = False):
 	"""
 	Plot a 2D numpy array with a color palette or a class dictionary for a categorical map.
+	Very large arrays are plotted at reduced resolution, unless axes = True.
 	"""
+	# imported here, as matplotlib is slow to load and only needed for plotting
+	from matplotlib import colors, colormaps
+	import matplotlib.pyplot as plt
 	if not isinstance(img_arr, np.ndarray):
 		print('Error: input must be a numpy array.', flush = True)
 		return
+	if (nodata is not None) and not isinstance(nodata, int):
+		print('Error: nodata must be an integer.', flush = True)
+		return
+	img_min = img_max = None
+	if (zmin is not None) or (zmax is not None) or (nodata is not None):
+		# one pass for both, reused below rather than recomputed over the whole array
+		img_min, img_max = _min_max(img_arr, nodata)
+	step = max(1, max(img_arr.shape) // _PLOT_MAX_SIZE)
+	if (step > 1) and not axes:
+		# far more cells than screen pixels, so plot every n-th cell (nearest sampling keeps class values intact)
+		img_arr = img_arr[::step, ::step]
 	if nodata is not None:
-		if isinstance(nodata, int):
-			mask = (img_arr == nodata)
-			img_arr = np.ma.masked_array(img_arr, mask)
-		else:
-			print('Error: nodata must be an integer.', flush = True)
-			return
+		# masked_equal() would also cast nodata to the array dtype as its fill_value, which fails for e.g. -9999 on an unsigned raster
+		img_arr = np.ma.masked_array(img_arr, mask = (img_arr == nodata), copy = False)
 	zmin_use = False
 	zmax_use = False
 	if zmin is not None:
 		if isinstance(zmin, int):
-			zmin_use = (zmin > np.min(img_arr))
+			zmin_use = (img_min is not None) and (zmin > img_min)
 		else:
 			print('Error: zmin must be an integer.', flush = True)
 			return
 	if zmax is not None:
 		if isinstance(zmax, int):
-			zmax_use = (zmax < np.max(img_arr))
+			zmax_use = (img_max is not None) and (zmax < img_max)
 		else:
 			print('Error: zmax must be an integer.', flush = True)
 			return
@@ -276,8 +745,8 @@ def plot(img_arr, pal = 'viridis', nodata = None, nodata_color = 'black', zmin =
 			cbar.ax.tick_params(labelsize = 'small')
 			if units is not None:
 				cbar.ax.set_ylabel(units, rotation = 270, labelpad = 20, fontsize = 'medium')
-		if nodata is not None:
-			if (nodata >= np.min(img_arr)) & (nodata <= np.max(img_arr)):
+		if legend and (nodata is not None) and (img_min is not None):
+			if (nodata >= img_min) & (nodata <= img_max):
 				cbar.ax.axhline(nodata, color = nodata_color, linewidth = 1)
 	elif isinstance(pal, dict):
 		# categorical data, e.g., pal = {0: 'red', 1: 'black', 255: 'white'}
@@ -293,7 +762,10 @@ def plot(img_arr, pal = 'viridis', nodata = None, nodata_color = 'black', zmin =
 		cmap.set_bad(nodata_color)
 		
 		# define boundaries and normalizatio
-		bounds = [val - 0.5 for val in class_values] + [class_values[-1] + 0.5]
+		class_arr = np.asarray(class_values, dtype = np.float64)
+		bounds = np.empty(nclasses + 1)
+		bounds[:-1] = class_arr - 0.5
+		bounds[-1] = class_arr[-1] + 0.5
 		norm = colors.BoundaryNorm(bounds, ncolors = nclasses)
 		
 		# create plot
@@ -301,7 +773,7 @@ def plot(img_arr, pal = 'viridis', nodata = None, nodata_color = 'black', zmin =
 		
 		if legend:
 			# define midpoints of each boundary, and set labels
-			mids = [(bounds[i] + bounds[i + 1]) / 2 for i in range(len(bounds) - 1)]
+			mids = 0.5 * (bounds[:-1] + bounds[1:])
 			
 			shrink = 0.1 * nclasses
 			cbar = plt.colorbar(im, cmap = cmap, ticks = mids, shrink = shrink, aspect = 3)
@@ -330,7 +802,7 @@ def plot(img_arr, pal = 'viridis', nodata = None, nodata_color = 'black', zmin =
 	if close:
 		plt.close()
 	else:
-		print("\033[93mDon't forget to close plot with plt.close()\033[0m")
+		print("\033[93mDon't forget to close plot with matplotlib.pyplot.close()\033[0m")
 
 def write_rat(src_file, rad, src_band = 1):
 	"""
@@ -362,13 +834,13 @@ def write_rat(src_file, rad, src_band = 1):
 	rat.CreateColumn('Description', gdal.GFT_String, gdal.GFU_Generic)
 
 	# populate table with keys and values from input dictionary	
+	# (whole columns at a time, rather than cell by cell)
 	nclasses = len(rad)
-	keys = list(rad.keys())
-	vals = list(rad.values())
+	keys = np.fromiter(rad.keys(), dtype = np.int32, count = nclasses)
+	vals = np.char.encode(np.array(list(rad.values()), dtype = str), 'utf-8')
 	rat.SetRowCount(nclasses)
-	for i in range(nclasses):
-		rat.SetValueAsInt(i, 0, keys[i]) # row, col, val
-		rat.SetValueAsString(i, 1, vals[i]) # row, col, val
+	rat.WriteArray(keys, 0) # values, col
+	rat.WriteArray(vals, 1) # values, col
 	
 	# add the table to the band
 	band.SetDefaultRAT(rat)
@@ -405,9 +877,9 @@ def write_rct(src_file, rcd, src_band = 1):
 	color_table = gdal.ColorTable()
 	
 	# populate table with keys and values from input dictionary	
+	set_color_entry = color_table.SetColorEntry
 	for pixel_value, hex_code in rcd.items():
-		rgb_tuple = hex2rgb(hex_code)
-		color_table.SetColorEntry(pixel_value, rgb_tuple)
+		set_color_entry(pixel_value, hex2rgb(hex_code))
 	
 	# add color table to raster, and set color interpretation
 	band.SetRasterColorTable(color_table)
@@ -438,6 +910,7 @@ def delete_rct(src_file, src_band = 1):
 
 def pcode(function):
 	"""Print function source code. Note, does not work for type = builtin_function_or_method."""
+	import inspect
 	if inspect.isfunction(function) == True:
 		source_code_lines = inspect.getsourcelines(function)
 		print(("".join(source_code_lines[0])), flush = True)
@@ -448,12 +921,13 @@ def check():
 	modname = os.path.splitext(os.path.basename(os.path.abspath(__file__)))[0]
 	print('{} loaded'.format(modname), flush = True)
 
+@functools.lru_cache(maxsize = 4096)
 def hex2rgb(hex_str):
 	"""
 	Convert Hex color code (str) to RGB value (tuple)
-	Source: https://stackoverflow.com/a/29643643
+	Cached, since color tables often repeat colors
 	"""
-	h = hex_str.lstrip('#')
-	return tuple(int(h[i:i+2], 16) for i in (0, 2, 4))
+	b = bytes.fromhex(hex_str.lstrip('#'))
+	return (b[0], b[1], b[2])
 
 
@@ -0,0 +1,4 @@
+import os, sys
+
+# raspy.py is a plain module at the repository root (see README), not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
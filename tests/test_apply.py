@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+import raspy
+
+@pytest.fixture(params = ['numba', 'python'])
+def backend(request, monkeypatch):
+	"""Run each test with the numba kernel (if installed) and with the pure python fallback"""
+	if request.param == 'numba':
+		pytest.importorskip('numba')
+	else:
+		monkeypatch.setattr(raspy, '_import_numba', lambda: None)
+	raspy.clear_cache()
+	return request.param
+
+ARR = np.arange(6, dtype = np.int16).reshape(2, 3)
+
+def test_output_dtype_follows_func(backend):
+	out = raspy.raster_apply(ARR, lambda x: x * 0.5 + 1)
+	assert out.dtype == np.float64
+	np.testing.assert_allclose(out, ARR * 0.5 + 1)
+	out = raspy.raster_apply(ARR, np.sqrt)
+	assert np.issubdtype(out.dtype, np.floating)
+	np.testing.assert_allclose(out, np.sqrt(ARR))
+
+def test_explicit_dtype(backend):
+	out = raspy.raster_apply(ARR.T, lambda x: x + 1, dtype = np.uint8)
+	assert out.dtype == np.uint8
+	np.testing.assert_array_equal(out, ARR.T + 1)
+
+def test_per_pixel_branch(backend):
+	np.testing.assert_array_equal(raspy.raster_apply(ARR, lambda x: x if x > 2 else 0), np.where(ARR > 2, ARR, 0))
+
+def test_closures_are_not_shared(backend):
+	for k in (2, 3):
+		np.testing.assert_array_equal(raspy.raster_apply(ARR, lambda x: x * k), ARR * k)
+
+def test_kernel_cache(backend):
+	for _ in range(3):
+		raspy.raster_apply(ARR, lambda x: x + 1)
+	assert len(raspy._APPLY_KERNELS) == (1 if backend == 'numba' else 0)
+	raspy.clear_cache()
+	assert len(raspy._APPLY_KERNELS) == 0
+
+def test_empty_and_bad_input(backend):
+	assert raspy.raster_apply(np.zeros((0, 3)), lambda x: x).shape == (0, 3)
+	assert raspy.raster_apply([1, 2], abs) is None
+	assert raspy.raster_apply(ARR, 3) is None
+
+SCALE = 2
+
+def test_rebound_global_recompiles(backend):
+	global SCALE
+	arr = np.arange(4.0)
+	for SCALE in (2, 3, 2.5):
+		np.testing.assert_array_equal(raspy.raster_apply(arr, lambda x: x * SCALE), arr * SCALE)
+	SCALE = 4
+	scale = lambda x: x * SCALE
+	raspy.raster_apply(arr, scale)
+	SCALE = 5
+	np.testing.assert_array_equal(raspy.raster_apply(arr, scale), arr * 5)
+
+def test_unhashable_global_is_not_cached(backend):
+	global SCALE
+	arr = np.arange(4.0)
+	for SCALE in (np.full(4, 2.0), np.full(4, 3.0)):
+		np.testing.assert_array_equal(raspy.raster_apply(arr, lambda x: x * SCALE[0]), arr * SCALE[0])
+	SCALE = 2
+
+def test_branches_do_not_narrow_dtype(backend):
+	# the first cell takes the integer-literal branch
+	arr = np.array([-1.0, 2.5, 3.7], dtype = np.float32)
+	out = raspy.raster_apply(arr, lambda x: x if x > 0 else 0)
+	assert np.issubdtype(out.dtype, np.floating)
+	np.testing.assert_allclose(out, [0, 2.5, 3.7], rtol = 1e-6)
+
+def test_dtype_not_narrower_than_input(backend):
+	out = raspy.raster_apply(ARR, lambda x: x > 2)
+	assert out.dtype == ARR.dtype
+	np.testing.assert_array_equal(out, ARR > 2)
+
+def test_int_branch_widens_with_numba(backend):
+	pytest.importorskip('numba')
+	if backend != 'numba':
+		pytest.skip('without numba the dtype comes from the first cell only')
+	out = raspy.raster_apply(ARR, lambda x: x / 2 if x > 2 else 0)
+	assert out.dtype == np.float64
+	np.testing.assert_allclose(out, np.where(ARR > 2, ARR / 2, 0))
@@ -0,0 +1,13 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('Agg')
+import raspy
+
+@pytest.mark.parametrize('nodata', [-1, -9999, 3, 255])
+def test_unsigned_nodata(capsys, nodata):
+	# nodata outside the dtype range (common for unsigned rasters) must not break masking
+	raspy.plot(np.arange(12, dtype = np.uint8).reshape(3, 4), nodata = nodata)
+	assert 'Error' not in capsys.readouterr().out
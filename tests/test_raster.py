@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+import raspy
+
+NROWS, NCOLS, NBANDS = 600, 700, 3
+
+@pytest.fixture(scope = 'module')
+def tif(tmp_path_factory):
+	"""3-band tiled GeoTIFF, larger than one block in each direction"""
+	path = str(tmp_path_factory.mktemp('raster') / 'test.tif')
+	arr = np.arange(NBANDS * NROWS * NCOLS, dtype = np.uint32).reshape(NBANDS, NROWS, NCOLS) % 65521
+	arr = arr.astype(np.uint16)
+	ds = gdal.GetDriverByName('GTiff').Create(path, NCOLS, NROWS, NBANDS, gdal.GDT_UInt16, options = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+	for i in range(NBANDS):
+		ds.GetRasterBand(i + 1).WriteArray(arr[i])
+	ds = None
+	return path, arr
+
+MODES = [dict(), dict(block = True), dict(memmap = True), dict(threaded = True), dict(cache = True)]
+
+@pytest.mark.parametrize('kwargs', MODES)
+@pytest.mark.parametrize('bands', [None, 2, [3, 1]])
+def test_full_read(tif, kwargs, bands):
+	path, arr = tif
+	expected = arr if bands is None else arr[bands - 1] if isinstance(bands, int) else arr[[b - 1 for b in bands]]
+	np.testing.assert_array_equal(raspy.raster(path, bands = bands, **kwargs), expected)
+
+@pytest.mark.parametrize('kwargs', MODES)
+@pytest.mark.parametrize('bands', [None, 2, [3, 1]])
+def test_window_read(tif, kwargs, bands):
+	path, arr = tif
+	# not aligned with the 256 x 256 blocks, and spanning several of them
+	xoff, yoff, xsize, ysize = 100, 250, 413, 300
+	sub = arr[:, yoff:yoff + ysize, xoff:xoff + xsize]
+	expected = sub if bands is None else sub[bands - 1] if isinstance(bands, int) else sub[[b - 1 for b in bands]]
+	np.testing.assert_array_equal(raspy.raster(path, bands = bands, window = (xoff, yoff, xsize, ysize), **kwargs), expected)
+
+@pytest.mark.parametrize('kwargs', MODES)
+@pytest.mark.parametrize('bands', [None, 2, [3, 1]])
+def test_out_shape_read(tif, kwargs, bands):
+	path, arr = tif
+	window = (100, 250, 413, 300)
+	expected = raspy.raster(path, bands = bands, window = window, out_shape = (75, 103))
+	assert expected.shape[-2:] == (75, 103)
+	np.testing.assert_array_equal(raspy.raster(path, bands = bands, window = window, out_shape = (75, 103), **kwargs), expected)
+
+def test_cache_key_includes_window(tif):
+	path, arr = tif
+	raspy.clear_cache()
+	full = raspy.raster(path, bands = 1, cache = True)
+	part = raspy.raster(path, bands = 1, cache = True, window = (0, 0, 10, 10))
+	assert full.shape == (NROWS, NCOLS) and part.shape == (10, 10)
+	assert raspy.raster(path, bands = 1, cache = True, window = (0, 0, 10, 10)) is part
+
+@pytest.mark.parametrize('window', [(-1, 0, 10, 10), (0, -1, 10, 10), (0, 0, 0, 10), (0, 0, 10, 0), (NCOLS - 5, 0, 10, 10), (0, NROWS - 5, 10, 10), (0, 0, 1, 2, 3)])
+@pytest.mark.parametrize('kwargs', MODES)
+def test_bad_window(tif, window, kwargs):
+	assert raspy.raster(tif[0], bands = [1, 2], window = window, **kwargs) is None
+
+@pytest.mark.parametrize('out_shape', [(0, 10), (10, -1), (10,)])
+def test_bad_out_shape(tif, out_shape):
+	assert raspy.raster(tif[0], out_shape = out_shape) is None
+
+@pytest.mark.parametrize('bands', [0, -1, NBANDS + 1, [1, 99], [0], [], [1, 2.0]])
+@pytest.mark.parametrize('kwargs', MODES)
+def test_bad_bands(tif, bands, kwargs):
+	assert raspy.raster(tif[0], bands = bands, **kwargs) is None
+
+def test_missing_file(tmp_path):
+	assert raspy.raster(str(tmp_path / 'missing.tif')) is None
+
+@pytest.mark.parametrize('band', [0, -1, NBANDS + 1])
+def test_metadata_bad_band(tif, band):
+	assert raspy.get_nodata(tif[0], band) is None
+	assert raspy.get_dtype(tif[0], band) is None
+
+def test_metadata(tif):
+	assert raspy.get_dtype(tif[0], NBANDS) == 'UInt16'
+	assert raspy.get_dims(tif[0]) == [NCOLS, NROWS, NBANDS]
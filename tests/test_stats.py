@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+import raspy
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+	"""Force chunked helpers to split small test arrays into several chunks"""
+	monkeypatch.setattr(raspy, '_CHUNK_SIZE', 4)
+
+@pytest.mark.parametrize('nan_at', [0, 5, -1])
+def test_nan_propagates(small_chunks, nan_at):
+	arr = np.linspace(-5, 5, 11, dtype = np.float32)
+	arr[nan_at] = np.nan
+	assert all(np.isnan(val) for val in raspy._min_max(arr))
+	assert all(np.isnan(val) for val in raspy._summary_stats(arr))
+
+def test_summary_stats_matches_numpy(small_chunks):
+	arr = np.random.default_rng(0).normal(size = (7, 9))
+	arr[2, 3] = -9999
+	valid = arr[arr != -9999]
+	img_min, img_max, img_mean, img_std = raspy._summary_stats(arr, -9999)
+	assert (img_min, img_max) == (valid.min(), valid.max())
+	assert np.isclose(img_mean, valid.mean()) and np.isclose(img_std, valid.std())
+
+def test_all_nodata(small_chunks):
+	assert raspy._min_max(np.zeros(10), 0) == (None, None)
+	assert raspy._summary_stats(np.zeros(10), 0) == (None, None, None, None)
+
+@pytest.mark.parametrize('nodata', [None, 0, 2, 2.0, 2.5, np.nan, -1])
+def test_classes_nodata(capsys, nodata):
+	pytest.importorskip('tabulate')
+	arr = np.array([[0, 1, 1], [2, 2, 2]], dtype = np.int16)
+	raspy.stats(arr, nodata = nodata, classes = True)
+	rows = [line.split() for line in capsys.readouterr().out.splitlines()[1:-1]]
+	expected = {0: 1, 1: 2, 2: 3}
+	if nodata in expected:
+		del expected[nodata]
+	assert {int(row[0]): int(row[1]) for row in rows} == expected
+
+@pytest.mark.parametrize('size', [0, 3, 4, 17, 40])
+def test_bincount_matches_numpy(small_chunks, size):
+	arr = np.random.default_rng(size).integers(0, 50, size).astype(np.uint16)
+	arr[-1:] = 49 if size < 17 else 1 # largest value in the last chunk, or not
+	np.testing.assert_array_equal(raspy._bincount(arr), np.bincount(arr))
+
+@pytest.mark.parametrize('transpose', [False, True])
+def test_compare_rasters(capsys, small_chunks, transpose):
+	r1 = np.arange(30).reshape(5, 6)
+	r2 = r1.copy()
+	r2[1, 2] = -1
+	if transpose:
+		r1, r2 = r1.T, r2.T
+	raspy.compare_rasters(r1, r2)
+	assert '(29/30 pixels)' in capsys.readouterr().out
+
+def test_compare_empty_rasters(capsys):
+	raspy.compare_rasters(np.zeros((0, 3)), np.zeros((0, 3)))
+	assert capsys.readouterr().out.startswith('Error')
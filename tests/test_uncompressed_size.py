@@ -0,0 +1,13 @@
+import os, sys
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'misc_clt'))
+from uncompressed_size import human_readable_size
+
+@pytest.mark.parametrize('size, expected', [
+	(0, '0.00 B'), (1023, '1023.00 B'), (1024, '1.00 KB'), (1024 ** 2 - 1, '1024.00 KB'),
+	(2 ** 50 - 1, '1024.00 TB'), (2 ** 50, '1.00 PB'), (2 ** 60, '1024.00 PB')
+])
+def test_human_readable_size(size, expected):
+	assert human_readable_size(size) == expected